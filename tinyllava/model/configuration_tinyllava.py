@@ -37,6 +37,8 @@ class TinyLlavaConfig(PretrainedConfig):
         tune_type_connector = 'frozen',
         tune_type_vision_tower = 'frozen',
         tune_vision_tower_from_layer = -1,
+        compile = False,
+        sort_bucket = False,
         
         **kwargs
 
@@ -66,6 +68,8 @@ class TinyLlavaConfig(PretrainedConfig):
         self.use_cache = use_cache
         self.cache_dir = cache_dir
         self.tokenizer_use_fast = tokenizer_use_fast
+        self.compile = compile
+        self.sort_bucket = sort_bucket
         self._load_text_config(text_config)
         self._load_vision_config(vision_config)
             
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from typing import List, Optional, Tuple, Union
 import ast
 
@@ -6,27 +6,124 @@ import torch
 import torch.utils.checkpoint
 from torch import nn
 
-from transformers import PreTrainedModel
+from transformers import PreTrainedModel, BitsAndBytesConfig
+from transformers.cache_utils import StaticCache
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.generation.utils import GenerateOutput
 
 from . import LLMFactory, ConnectorFactory, VisionTowerFactory
 from .configuration_tinyllava import TinyLlavaConfig
 from ..utils.constants import *
-# from tinyllava.utils.data_utils import get_value_from_kwargs
 
-#from safetensors import safe_open
-from safetensors.torch import load_file
+from packaging import version
+from safetensors import safe_open
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 import os
 import json
 
-def get_value_from_kwargs(kwargs, name):
-    if name in kwargs:
-        return kwargs.pop(name)
-    else:
-        return None
+@dataclass
+class LoadArgs:
+    """Loading options handled by TinyLlavaForConditionalGeneration itself. They are
+    taken out of kwargs once; whatever is left is forwarded to the underlying
+    from_pretrained / load_model calls."""
+    full_state_dict: Optional[dict] = None
+    model_name_or_path: Optional[str] = None
+    pretrained_llm_path: Optional[str] = None
+    pretrained_model_path: Optional[str] = None
+    target_device: Optional[Union[str, torch.device]] = None
+    assign: bool = False
+    quant: Optional[str] = None
+    vision_int8: bool = False
+
+    @classmethod
+    def pop_from(cls, kwargs):
+        return cls(**{field.name: kwargs.pop(field.name) for field in fields(cls) if field.name in kwargs})
     
 
+def load_safetensors(file_path, tensor_names=None, device="cpu", dtype=None):
+    """Read tensors from a (memory-mapped) safetensors file, only materializing the requested ones.
+    With a non-CPU device the tensors are created there directly, without a CPU copy, and
+    floating point tensors are cast to dtype (if given) one at a time as they are read."""
+    state_dict = {}
+    with safe_open(file_path, framework="pt", device=str(device)) as f:
+        available = set(f.keys())
+        for tensor_name in (f.keys() if tensor_names is None else tensor_names):
+            if tensor_name in available:
+                tensor = f.get_tensor(tensor_name)
+                if dtype is not None and tensor.is_floating_point():
+                    tensor = tensor.to(dtype=dtype)
+                state_dict[tensor_name] = tensor
+            else:
+                print(f"Warning: Tensor {tensor_name} not found in {file_path}")
+    return state_dict
+
+
+def load_state_dict_into(module, state_dict, strict=True, assign=False):
+    # `assign` only exists on torch>=2.1, so it is passed only when actually used
+    if assign:
+        # assigned tensors keep their own dtype, unlike copy_ which keeps the module's, so cast
+        # them first to end up with the same model as the copying (CPU) path
+        current = module.state_dict()
+        state_dict = {
+            k: v.to(dtype=current[k].dtype) if k in current and v.is_floating_point() and current[k].is_floating_point() else v
+            for k, v in state_dict.items()
+        }
+        return module.load_state_dict(state_dict, strict=strict, assign=True)
+    return module.load_state_dict(state_dict, strict=strict)
+
+
+def resolve_torch_dtype(torch_dtype):
+    """Turn the torch_dtype forms accepted by huggingface from_pretrained (torch.dtype,
+    'float16', 'torch.float16', 'auto') into a torch.dtype, or None for 'auto'/None."""
+    if torch_dtype is None or torch_dtype == 'auto':
+        return None
+    dtype = getattr(torch, torch_dtype.replace('torch.', ''), None) if isinstance(torch_dtype, str) else torch_dtype
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f"Unsupported torch_dtype: {torch_dtype}")
+    return dtype
+
+
+def replace_linear_with_bnb(module, quantization_config, skip_modules=('lm_head',)):
+    """Swap the nn.Linear layers of an already loaded module for bitsandbytes layers.
+    bitsandbytes quantizes weights on a CPU -> GPU move, so the new parameters are built
+    on CPU and moved back to the layer's device (quantized right away if that is a GPU)."""
+    import bitsandbytes as bnb
+    for name, child in module.named_children():
+        if name in skip_modules:
+            continue
+        if isinstance(child, nn.Linear):
+            if quantization_config.load_in_4bit:
+                new_module = bnb.nn.Linear4bit(
+                    child.in_features, child.out_features, bias=child.bias is not None,
+                    compute_dtype=quantization_config.bnb_4bit_compute_dtype,
+                    quant_type=quantization_config.bnb_4bit_quant_type,
+                )
+                new_module.weight = bnb.nn.Params4bit(
+                    child.weight.data.cpu(), requires_grad=False, quant_type=quantization_config.bnb_4bit_quant_type
+                )
+            else:
+                new_module = bnb.nn.Linear8bitLt(
+                    child.in_features, child.out_features, bias=child.bias is not None,
+                    has_fp16_weights=False, threshold=quantization_config.llm_int8_threshold,
+                )
+                new_module.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+            if child.bias is not None:
+                new_module.bias = child.bias
+            new_module.to(child.weight.device)
+            new_module.requires_grad_(False)
+            setattr(module, name, new_module)
+        else:
+            replace_linear_with_bnb(child, quantization_config, skip_modules)
+
+
+# inductor options used when config.compile is set; "triton.cudagraphs" is what
+# mode="reduce-overhead" enables (torch.compile does not accept mode and options together)
+INDUCTOR_CONFIGS = {
+    "coordinate_descent_tuning": True,
+    "triton.cudagraphs": True,
+}
+
 
 class TinyLlavaPreTrainedModel(PreTrainedModel):
     config_class = TinyLlavaConfig
@@ -65,11 +162,11 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         
         super().__init__(config)
 
-        self.language_model = LLMFactory(config.llm_model_name_or_path)[0](config.text_config)
+        llm_cls, (Tokenizer, post_load) = LLMFactory(config.llm_model_name_or_path)
+        self.language_model = llm_cls(config.text_config)
         self.vision_tower = VisionTowerFactory(config.vision_model_name_or_path)(config.vision_config)
         self.connector = ConnectorFactory(config.connector_type)(config)
         
-        (Tokenizer, post_load) = LLMFactory(config.llm_model_name_or_path)[1]
         self.tokenizer = post_load(Tokenizer.from_pretrained(
             config.tokenizer_name_or_path,
             cache_dir = config.cache_dir,
@@ -78,6 +175,31 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
             use_fast = config.tokenizer_use_fast,
         ))
         self.post_init()
+        if getattr(config, 'compile', False):
+            self.encode_images = torch.compile(self.encode_images, options=INDUCTOR_CONFIGS)
+            self._compile_language_model()
+
+    def _compile_language_model(self):
+        # compile forward rather than wrapping the module so state_dict keys stay unchanged;
+        # called again from load_llm since from_pretrained replaces self.language_model
+        if getattr(self.config, 'compile', False):
+            forward = self.language_model.forward
+            self.language_model.forward = torch.compile(forward, options=INDUCTOR_CONFIGS)
+            # With a static KV cache (see generate) every one-token decode step has the same
+            # shapes and can be captured as one graph. Only generate uses this; training (e.g.
+            # with gradient checkpointing) and plain forward calls keep the graph-break tolerant
+            # version, and the prefill runs eagerly since its length changes with every prompt.
+            self._decode_forward = None
+            if getattr(self.language_model, '_supports_static_cache', False):
+                decode_step = torch.compile(forward, fullgraph=True, options=INDUCTOR_CONFIGS)
+
+                def decode_forward(**kwargs):
+                    input_ids = kwargs.get('input_ids')
+                    if kwargs.get('inputs_embeds') is None and input_ids is not None and input_ids.shape[1] == 1:
+                        return decode_step(**kwargs)
+                    return forward(**kwargs)
+
+                self._decode_forward = decode_forward
 
     
     def get_input_embeddings(self):
@@ -124,6 +246,7 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         images: Optional[torch.FloatTensor] = None,
         image_sizes: Optional[List[List[int]]] = None,
         return_dict: Optional[bool] = None,
+        return_logits: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         use_cache = use_cache if use_cache is not None else self.config.use_cache
         if inputs_embeds is None:
@@ -143,6 +266,13 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                 images,
                 image_sizes
             )
+        # bucketing only for right padding: trimming a left-padded batch shifts each row's
+        # position ids, so its loss would no longer match the unsplit batch
+        if (getattr(self.config, 'sort_bucket', False) and inputs_embeds is not None and inputs_embeds.shape[0] > 1
+                and getattr(self.config, 'tokenizer_padding_side', 'right') == 'right'
+                and attention_mask is not None and past_key_values is None
+                and not use_cache and not output_attentions and not output_hidden_states):
+            return self._forward_sorted_buckets(inputs_embeds, attention_mask, position_ids, labels, return_dict, return_logits)
         return self.language_model.forward(
             input_ids=input_ids,
             attention_mask=attention_mask,
@@ -155,7 +285,52 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict
         )
-    
+
+    def _forward_sorted_buckets(self, inputs_embeds, attention_mask, position_ids, labels, return_dict=None, return_logits=None):
+        # Rows are sorted by length and run as a short and a long half, each trimmed to its
+        # own longest row, so the short half does not attend over the batch-wide padding.
+        lens = attention_mask.sum(dim=1)
+        order = torch.argsort(lens)
+        max_len = inputs_embeds.shape[1]
+        # a training step only needs the loss, so unless return_logits asks for them the padded
+        # full-batch logits (the largest activation) are only assembled outside training
+        keep_logits = return_logits if return_logits is not None else labels is None or not self.training
+
+        logits = None
+        loss = None
+        num_tokens = 0
+        for bucket in order.chunk(2):
+            bucket_len = int(lens[bucket].max())
+            columns = slice(0, bucket_len)
+            bucket_labels = labels[bucket, columns] if labels is not None else None
+            outputs = self.language_model.forward(
+                attention_mask=attention_mask[bucket, columns],
+                position_ids=position_ids[bucket, columns] if position_ids is not None else None,
+                inputs_embeds=inputs_embeds[bucket, columns],
+                use_cache=False,
+                return_dict=True
+            )
+            if keep_logits:
+                if logits is None:
+                    logits = outputs.logits.new_zeros((inputs_embeds.shape[0], max_len, outputs.logits.shape[-1]))
+                logits[bucket, columns] = outputs.logits
+            if bucket_labels is not None:
+                # summed here and divided by the total token count below, so the loss is the
+                # same per-token mean the unsplit batch would give
+                shift_logits = outputs.logits[:, :-1].reshape(-1, outputs.logits.shape[-1]).float()
+                shift_labels = bucket_labels[:, 1:].reshape(-1).to(shift_logits.device)
+                bucket_loss = nn.functional.cross_entropy(shift_logits, shift_labels, ignore_index=IGNORE_INDEX, reduction='sum')
+                loss = bucket_loss if loss is None else loss + bucket_loss
+                num_tokens = num_tokens + (shift_labels != IGNORE_INDEX).sum()
+        if loss is not None:
+            loss = loss / num_tokens
+
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        if not return_dict:
+            output = (logits,) if logits is not None else ()
+            return (loss,) + output if loss is not None else output
+        return CausalLMOutputWithPast(loss=loss, logits=logits)
+
     @torch.no_grad()
     def generate(
         self,
@@ -189,20 +364,61 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         else:
             inputs_embeds = self.language_model.get_input_embeddings()(inputs)
 
-        return self.language_model.generate(
-            position_ids=position_ids,
-            attention_mask=attention_mask,
-            inputs_embeds=inputs_embeds,
-            **kwargs
+        decode_forward = getattr(self, '_decode_forward', None)
+        max_new_tokens = kwargs.get('max_new_tokens', None)
+        if (decode_forward is None or max_new_tokens is None or 'past_key_values' in kwargs
+                or getattr(self.language_model.config, '_attn_implementation', None) == "flash_attention_2"):
+            return self.language_model.generate(
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                inputs_embeds=inputs_embeds,
+                **kwargs
+            )
+
+        # Preallocated KV cache instead of growing it every step, so the compiled decode step
+        # keeps the same shapes (and CUDA graph) across tokens. It is built here rather than via
+        # cache_implementation='static', which sizes it from max_length and so leaves out the
+        # prompt when generating from inputs_embeds. Its length is rounded up so that prompts of
+        # different lengths still share the same decode graph.
+        llm_config = self.language_model.config
+        max_cache_len = -(-(inputs_embeds.shape[1] + max_new_tokens) // 256) * 256
+        kwargs['past_key_values'] = StaticCache(
+            llm_config,
+            max_batch_size=inputs_embeds.shape[0] * kwargs.get('num_beams', 1),
+            max_cache_len=max_cache_len,
+            device=inputs_embeds.device,
+            dtype=getattr(llm_config, '_pre_quantization_dtype', self.language_model.dtype),
         )
+        compiled_forward = self.language_model.forward
+        self.language_model.forward = decode_forward
+        try:
+            return self.language_model.generate(
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                inputs_embeds=inputs_embeds,
+                **kwargs
+            )
+        finally:
+            self.language_model.forward = compiled_forward
         
     def encode_images(self, images):
         kwargs = {}
         kwargs['vision_feature_layer'] = self.config.vision_feature_layer
         kwargs['vision_feature_select_strategy'] = self.config.vision_feature_select_strategy
-        images = images.to(device=self.device, dtype=self.dtype)
-        image_features = self.vision_tower(images, **kwargs)
-        image_features = self.connector(image_features)
+        images = images.to(device=self.device, dtype=self.dtype, non_blocking=True)
+        if getattr(self, '_vision_int8', False) and (images.device.type != 'cpu' or images.dtype != torch.float32):
+            raise ValueError(
+                f"The int8 vision tower only runs on CPU with float32 inputs, got {images.dtype} on "
+                f"{images.device}; keep the model in float32 on CPU when loading with vision_int8"
+            )
+        # a float32 model runs the vision tower and connector matmuls in bf16 on GPUs that
+        # support it; half precision models, CPU (e.g. an int8 vision tower) and callers that
+        # already set up their own autocast (e.g. fp16 AMP training) are left as is
+        use_bf16 = (images.dtype == torch.float32 and images.device.type == 'cuda'
+                    and not torch.is_autocast_enabled() and torch.cuda.is_bf16_supported())
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_bf16):
+            image_features = self.vision_tower(images, **kwargs)
+            image_features = self.connector(image_features)
         return image_features
     
     
@@ -228,13 +444,21 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
-        
+        if getattr(self.config, 'compile', False) and images.shape[0] > 1:
+            # avoid recompiling the vision tower for every new number of images
+            torch._dynamo.mark_dynamic(images, 0)
         image_features = self.encode_images(images)
 
         # TODO: image start / end is not implemented here to support pretraining.
         if getattr(self.config, 'tune_mm_mlp_adapter', False):
             raise NotImplementedError
 
+        # a single unpadded sequence (the usual generate() call) needs no padding bookkeeping
+        if input_ids.shape[0] == 1 and attention_mask is None:
+            return self._prepare_single_inputs_labels_for_multimodal(
+                input_ids, position_ids, past_key_values, labels, image_features
+            )
+
         # Let's just add dummy tensors if they do not exist,
         # it is a headache to deal with None all the time.
         # But it is not ideal, and if you have a better idea,
@@ -242,119 +466,156 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         _labels = labels
         _position_ids = position_ids
         _attention_mask = attention_mask
+        embed_tokens = self.language_model.get_input_embeddings()
+        device = input_ids.device
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
         else:
             attention_mask = attention_mask.bool()
         if position_ids is None:
-            position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=input_ids.device)
+            position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=device)
         if labels is None:
             labels = torch.full_like(input_ids, IGNORE_INDEX)
 
-        # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
-        input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
-        labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
-
-        new_input_embeds = []
-        new_labels = []
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0:
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.language_model.get_input_embeddings()(cur_input_ids)
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0]], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-
-            image_token_indices = [-1] + torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [cur_input_ids.shape[0]]
-            cur_input_ids_noim = []
-            cur_labels = labels[batch_idx]
-            cur_labels_noim = []
-            for i in range(len(image_token_indices) - 1):
-                cur_input_ids_noim.append(cur_input_ids[image_token_indices[i]+1:image_token_indices[i+1]])
-                cur_labels_noim.append(cur_labels[image_token_indices[i]+1:image_token_indices[i+1]])
-            split_sizes = [x.shape[0] for x in cur_labels_noim]
-            cur_input_embeds = self.language_model.get_input_embeddings()(torch.cat(cur_input_ids_noim))
-            cur_input_embeds_no_im = torch.split(cur_input_embeds, split_sizes, dim=0)
-            cur_new_input_embeds = []
-            cur_new_labels = []
-
-            for i in range(num_images + 1):
-                cur_new_input_embeds.append(cur_input_embeds_no_im[i])
-                cur_new_labels.append(cur_labels_noim[i])
-                if i < num_images:
-                    cur_image_features = image_features[cur_image_idx]
-                    cur_image_idx += 1
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=cur_labels.device, dtype=cur_labels.dtype))
-
-            cur_new_input_embeds = [x.to(self.device) for x in cur_new_input_embeds]
-
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-            cur_new_labels = torch.cat(cur_new_labels)
-
-            new_input_embeds.append(cur_new_input_embeds)
-            new_labels.append(cur_new_labels)
+        # Merge the whole batch at once instead of looping over samples: embed every
+        # text token with a single lookup, then compute where each token lands once
+        # every IMAGE_TOKEN_INDEX slot is expanded into its image patches, and write
+        # text embeddings and image features there. Padded tokens (attention_mask == 0)
+        # are dropped on the way.
+        image_mask = (input_ids == IMAGE_TOKEN_INDEX) & attention_mask
+        text_mask = attention_mask & ~image_mask
+        inputs_embeds = embed_tokens(input_ids.masked_fill(~text_mask, 0))
+        batch_size, num_patches, hidden_size = input_ids.shape[0], image_features.shape[1], inputs_embeds.shape[-1]
+        image_features = image_features.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype)
+
+        # samples without an image token still consume one (dummy) image
+        num_images = image_mask.sum(dim=1)
+        image_offsets = torch.cumsum(num_images.clamp(min=1), dim=0) - num_images.clamp(min=1)
+        image_ids = image_offsets[:, None] + torch.cumsum(image_mask, dim=1) - 1
+
+        token_lens = text_mask.long() + image_mask.long() * num_patches
+        new_positions = torch.cumsum(token_lens, dim=1) - token_lens
+        new_lens = token_lens.sum(dim=1)
 
         # Truncate sequences to max length as image embeddings can make the sequence longer
         tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
         if tokenizer_model_max_length is not None:
-            new_input_embeds = [x[:tokenizer_model_max_length] for x in new_input_embeds]
-            new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
-
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-
-        new_input_embeds_padded = []
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=new_labels[0].dtype, device=new_labels[0].device)
-        attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
-        position_ids = torch.zeros((batch_size, max_len), dtype=position_ids.dtype, device=position_ids.device)
-
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
-                new_input_embeds_padded.append(torch.cat((
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device),
-                    cur_new_embed
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, -cur_len:] = cur_new_labels
-                    attention_mask[i, -cur_len:] = True
-                    position_ids[i, -cur_len:] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
-            else:
-                new_input_embeds_padded.append(torch.cat((
-                    cur_new_embed,
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, :cur_len] = cur_new_labels
-                    attention_mask[i, :cur_len] = True
-                    position_ids[i, :cur_len] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
+            new_lens = new_lens.clamp(max=tokenizer_model_max_length)
+        max_len = int(new_lens.max())
+
+        # Padding is applied while scattering: left-padded rows are shifted to end at
+        # max_len, and anything past a (truncated) row's end goes to a scratch column
+        # that is sliced off afterwards.
+        if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
+            pad_lens = max_len - new_lens
+        else:
+            pad_lens = torch.zeros_like(new_lens)
+
+        def scatter_positions(batch_idx, positions):
+            return torch.where(positions < new_lens[batch_idx], positions + pad_lens[batch_idx], max_len)
+
+        new_input_embeds = inputs_embeds.new_zeros((batch_size, max_len + 1, hidden_size))
+        new_labels = torch.full((batch_size, max_len + 1), IGNORE_INDEX, dtype=labels.dtype, device=device)
+
+        # text tokens are scattered densely (non-text slots go to the scratch column), so the
+        # only data-dependent shape, and host sync besides max_len, is the image token nonzero
+        text_positions = scatter_positions(torch.arange(batch_size, device=device)[:, None], new_positions)
+        text_positions = text_positions.masked_fill(~text_mask, max_len)
+        new_input_embeds.scatter_(1, text_positions[..., None].expand(-1, -1, hidden_size), inputs_embeds)
+        new_labels.scatter_(1, text_positions, labels)
+
+        batch_idx, token_idx = image_mask.nonzero(as_tuple=True)
+        patch_positions = new_positions[batch_idx, token_idx][:, None] + torch.arange(num_patches, device=device)
+        patch_positions = scatter_positions(batch_idx[:, None], patch_positions)
+        new_input_embeds.index_put_(
+            (batch_idx[:, None].expand_as(patch_positions), patch_positions),
+            image_features[image_ids[batch_idx, token_idx]]
+        )
 
-        new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
+        new_input_embeds = new_input_embeds[:, :max_len]
+        new_labels = new_labels[:, :max_len]
+
+        # attention_mask and position_ids both come from the offset of each slot within its row
+        position_ids = (torch.arange(max_len, device=device)[None, :] - pad_lens[:, None]).to(position_ids.dtype)
+        attention_mask = (position_ids >= 0) & (position_ids < new_lens[:, None])
+        position_ids = position_ids.masked_fill_(~attention_mask, 0)
 
         if _labels is None:
             new_labels = None
-        else:
-            new_labels = new_labels_padded
 
-        if _attention_mask is None:
-            attention_mask = None
-        else:
+        if _attention_mask is not None:
             attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
+        elif getattr(self.language_model.config, '_attn_implementation', None) == "flash_attention_2":
+            # merged rows can differ in length even without an input mask; with the mask,
+            # flash attention unpads the batch and runs the varlen kernel instead of
+            # attending over the padding
+            attention_mask = attention_mask.long()
+        else:
+            attention_mask = None
 
         if _position_ids is None:
             position_ids = None
         return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
+
+    def _prepare_single_inputs_labels_for_multimodal(self, input_ids, position_ids, past_key_values, labels, image_features):
+        cur_input_ids = input_ids[0]
+        image_mask = cur_input_ids == IMAGE_TOKEN_INDEX
+        image_token_indices = image_mask.nonzero(as_tuple=True)[0].tolist()
+        cur_input_embeds = self.language_model.get_input_embeddings()(cur_input_ids.masked_fill(image_mask, 0))
+        image_features = image_features.to(device=cur_input_embeds.device, dtype=cur_input_embeds.dtype)
+
+        # with no image token the (dummy) image is simply not used
+        starts = [0] + [i + 1 for i in image_token_indices]
+        ends = image_token_indices + [cur_input_ids.shape[0]]
+        new_input_embeds = []
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if i > 0:
+                new_input_embeds.append(image_features[i - 1])
+            new_input_embeds.append(cur_input_embeds[start:end])
+        new_input_embeds = torch.cat(new_input_embeds)
+
+        new_labels = None
+        if labels is not None:
+            cur_labels = labels[0]
+            new_labels = []
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                if i > 0:
+                    new_labels.append(cur_labels.new_full((image_features.shape[1],), IGNORE_INDEX))
+                new_labels.append(cur_labels[start:end])
+            new_labels = torch.cat(new_labels)
+
+        # Truncate sequences to max length as image embeddings can make the sequence longer
+        tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
+        if tokenizer_model_max_length is not None:
+            new_input_embeds = new_input_embeds[:tokenizer_model_max_length]
+            if new_labels is not None:
+                new_labels = new_labels[:tokenizer_model_max_length]
+
+        if position_ids is not None:
+            position_ids = torch.arange(new_input_embeds.shape[0], dtype=position_ids.dtype, device=position_ids.device)[None]
+        if new_labels is not None:
+            new_labels = new_labels[None]
+        return None, position_ids, None, past_key_values, new_input_embeds[None], new_labels
       
     
-    def load_llm(self, **kwargs):
-        full_state_dict = get_value_from_kwargs(kwargs, 'full_state_dict')
+    def load_llm(self, load_args=None, **kwargs):
+        load_args = load_args or LoadArgs.pop_from(kwargs)
+        full_state_dict = load_args.full_state_dict
+        assign = load_args.assign
+        quant = load_args.quant
+        quantization_config = None
+        if quant is not None:
+            # the LLM is frozen, so its weights can stay quantized for the matmuls
+            if quant not in ('nf4', 'int8'):
+                raise ValueError(f"quant {quant} not supported, use nf4 or int8")
+            if quant == 'nf4':
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type='nf4',
+                    bnb_4bit_compute_dtype=resolve_torch_dtype(kwargs.get('torch_dtype', None)) or torch.bfloat16,
+                )
+            else:
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
         if full_state_dict is not None:
             print('Loading language model weights from provided checkpoint (full_state_dict)...')
             llm_state_dict = {}
@@ -363,23 +624,32 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                     llm_state_dict[k[15:]] = v
             
             try:
-                self.language_model.load_state_dict(llm_state_dict, strict=False)
+                load_state_dict_into(self.language_model, llm_state_dict, strict=False, assign=assign)
+                if assign:
+                    # assigned parameters replace the tied ones, so tie them again
+                    self.language_model.tie_weights()
                 print("Language model weights loaded successfully from full_state_dict.")
             except RuntimeError as e:
                 print(f"Error loading language model weights from full_state_dict: {e}")
                 # You might want to log this or raise a more specific error
                 raise e # Or handle gracefully, e.g., fall back to original loading if possible
+            if quantization_config is not None:
+                replace_linear_with_bnb(self.language_model, quantization_config)
+                print(f"Language model linear layers converted to {quant}.")
         else:
             # Original LLM loading logic (e.g., from huggingface/local path)
-            language_model_name = get_value_from_kwargs(kwargs, 'model_name_or_path')
-            pretrained_llm_path = get_value_from_kwargs(kwargs, 'pretrained_llm_path')
+            language_model_name = load_args.model_name_or_path
+            pretrained_llm_path = load_args.pretrained_llm_path
             if pretrained_llm_path is not None:
                 language_model_name = pretrained_llm_path
             
+            if quantization_config is not None:
+                kwargs.setdefault('quantization_config', quantization_config)
             if language_model_name is not None:
                 self.language_model = self.language_model.from_pretrained(
                     language_model_name, **kwargs
                 )
+                self._compile_language_model()
             print('loading language model from ', language_model_name)
             
         self.language_model.requires_grad_(False) # Freeze LLM weights for finetuning
@@ -391,8 +661,11 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         #self.config.tokenizer_model_max_length =  getattr(self.tokenizer, 'model_max_length', None)
         
         
-    def load_vision_tower(self, **kwargs):
-        full_state_dict = get_value_from_kwargs(kwargs, 'full_state_dict')
+    def load_vision_tower(self, load_args=None, **kwargs):
+        load_args = load_args or LoadArgs.pop_from(kwargs)
+        full_state_dict = load_args.full_state_dict
+        assign = load_args.assign
+        vision_int8 = load_args.vision_int8
         
         if full_state_dict is not None:
             print('Loading vision tower weights from provided checkpoint (full_state_dict)...')
@@ -402,20 +675,34 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                     vision_tower_state_dict[k[13:]] = v
             
             try:
-                self.vision_tower.load_state_dict(vision_tower_state_dict, strict=True)
+                load_state_dict_into(self.vision_tower, vision_tower_state_dict, strict=True, assign=assign)
                 print("Vision tower weights loaded successfully from full_state_dict.")
             except RuntimeError as e:
                 print(f"Error loading vision tower weights from full_state_dict: {e}")
                 raise e
         else:
             # Original Vision Tower loading logic
-            vision_tower_name = get_value_from_kwargs(kwargs, 'model_name_or_path')
+            vision_tower_name = load_args.model_name_or_path
             self.vision_tower.load_model(vision_tower_name, **kwargs)
             print('loading vision tower from ', vision_tower_name)
 
+        if vision_int8:
+            # The vision tower is frozen, so its linear layers can be post-training quantized
+            # (int8 weights, activations quantized on the fly). The quantized kernels only run
+            # on CPU with float32 inputs; check accuracy on the target before enabling.
+            if self.device.type != 'cpu' or self.dtype != torch.float32:
+                raise ValueError(
+                    f"vision_int8 requires a float32 model on CPU, got {self.dtype} on {self.device}"
+                )
+            torch.ao.quantization.quantize_dynamic(self.vision_tower, {nn.Linear}, dtype=torch.qint8, inplace=True)
+            self._vision_int8 = True
+            print('Vision tower quantized to int8.')
+
         
-    def load_connector(self, **kwargs):
-        full_state_dict = get_value_from_kwargs(kwargs, 'full_state_dict')
+    def load_connector(self, load_args=None, **kwargs):
+        load_args = load_args or LoadArgs.pop_from(kwargs)
+        full_state_dict = load_args.full_state_dict
+        assign = load_args.assign
         if full_state_dict is not None:
             print('Loading connector weights from provided checkpoint (full_state_dict)...')
             connector_state_dict = {}
@@ -424,12 +711,12 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                     connector_state_dict[k[10:]] = v
             
             try:
-                self.connector.load_state_dict(connector_state_dict, strict=True)
+                load_state_dict_into(self.connector, connector_state_dict, strict=True, assign=assign)
                 print("Connector weights loaded successfully from full_state_dict.")
             except RuntimeError as e:
                 print(f"Error loading connector weights with strict=True from full_state_dict: {e}")
                 print("Attempting to load with strict=False.")
-                self.connector.load_state_dict(connector_state_dict, strict=False)
+                load_state_dict_into(self.connector, connector_state_dict, strict=False, assign=assign)
                 print("Connector weights loaded successfully with strict=False from full_state_dict.")
         else:
             # Original Connector loading logic
@@ -448,11 +735,21 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
         config = model_config 
         model = cls(config) # __init__을 통해 LLM, Vision Tower, Connector 초기화
         
-        pretrained_path = get_value_from_kwargs(kwargs, 'pretrained_model_path')
+        load_args = LoadArgs.pop_from(kwargs)
+        pretrained_path = load_args.pretrained_model_path
+        # target_device가 주어지면 텐서를 해당 디바이스에 바로 로드하고 (CPU 경유 없음),
+        # load_state_dict(assign=True)로 복사 없이 파라미터를 교체합니다. (torch>=2.1 필요)
+        target_device = load_args.target_device or 'cpu'
+        if str(target_device) != 'cpu' and version.parse(torch.__version__).release < (2, 1):
+            raise ValueError(f"target_device requires torch>=2.1 (load_state_dict(assign=True)), found torch {torch.__version__}")
+        # torch_dtype가 주어지면 각 텐서를 읽는 즉시 해당 dtype으로 변환합니다.
+        # 'float16' 같은 문자열이나 'auto'도 torch.dtype(또는 None)으로 변환해 둡니다.
+        target_dtype = resolve_torch_dtype(kwargs.get('torch_dtype', None))
+        full_state_dict = None
         
         if os.path.isfile(pretrained_path) and pretrained_path.endswith('.safetensors'):
             print(f"Found safetensors file at {pretrained_path}. Loading checkpoint.")
-            full_state_dict = load_file(pretrained_path)
+            full_state_dict = load_safetensors(pretrained_path, device=target_device, dtype=target_dtype)
 
         # Case 2: 디렉토리인 경우
         elif os.path.isdir(pretrained_path):
@@ -462,7 +759,7 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
 
             if os.path.isfile(single_file):
                 print(f"Found model.safetensors at {single_file}. Loading checkpoint.")
-                full_state_dict = load_file(single_file)
+                full_state_dict = load_safetensors(single_file, device=target_device, dtype=target_dtype)
 
             elif os.path.isfile(index_file):
                 print(f"Found safetensors index at {index_file}. Loading split checkpoint from directory.")
@@ -475,12 +772,11 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                 # weight_map은 각 텐서가 어느 파일에 있는지 매핑 정보를 포함
                 if 'weight_map' in index_data:
                     # 파일 경로를 키로, 해당 파일에 속하는 텐서들의 리스트를 값으로 하는 딕셔너리
-                    files_to_load = {}
+                    files_to_load = defaultdict(list)
                     for tensor_name, file_name in index_data['weight_map'].items():
-                        if file_name not in files_to_load:
-                            files_to_load[file_name] = []
                         files_to_load[file_name].append(tensor_name)
 
+                    parts_to_load = []
                     for file_name, tensor_names in files_to_load.items():
                         file_path = os.path.join(pretrained_path, file_name)
                         if not os.path.isfile(file_path):
@@ -488,31 +784,35 @@ class TinyLlavaForConditionalGeneration(TinyLlavaPreTrainedModel):
                             continue
 
                         print(f"Loading part from {file_path}")
-                        part_state_dict = load_file(file_path)
-                        
-                        for tensor_name in tensor_names:
-                            if tensor_name in part_state_dict:
-                                full_state_dict[tensor_name] = part_state_dict[tensor_name]
-                            else:
-                                print(f"Warning: Tensor {tensor_name} not found in {file_path}")
+                        parts_to_load.append((file_path, tensor_names, target_device, target_dtype))
+
+                    # 각 shard를 mmap으로 열고 여러 스레드에서 동시에 읽어 디스크 I/O를 겹칩니다.
+                    with ThreadPoolExecutor(max_workers=4) as executor:
+                        for part_state_dict in executor.map(lambda part: load_safetensors(*part), parts_to_load):
+                            full_state_dict.update(part_state_dict)
 
         if full_state_dict is not None:
-            # kwargs에 full_state_dict를 추가하여 개별 load 함수로 전달합니다.
-            kwargs['full_state_dict'] = full_state_dict
+            # load_args에 full_state_dict를 설정하여 개별 load 함수로 전달합니다.
+            load_args.full_state_dict = full_state_dict
+            load_args.assign = str(target_device) != 'cpu'
             
             # 각 컴포넌트 로드 함수를 호출합니다.
-            model.load_llm(**kwargs)
-            model.load_vision_tower(**kwargs)
-            model.load_connector(**kwargs)
+            model.load_llm(load_args, **kwargs)
+            model.load_vision_tower(load_args, **kwargs)
+            model.load_connector(load_args, **kwargs)
             
             print("All components (LLM, Vision Tower, Connector) loaded from model.safetensors successfully.")
         else:
             print(f"No model.safetensors found from provided config path. Proceeding with default loading behavior.")
             # model.safetensors가 없을 때, 기존 load_llm 등의 else 블록이 실행되도록 개별 호출합니다.
-            # 이 kwargs에는 'full_state_dict'가 없으므로 기존 로딩 로직이 작동합니다.
-            model.load_llm(**kwargs)
-            model.load_vision_tower(**kwargs)
-            model.load_connector(**kwargs)
+            # load_args.full_state_dict가 None이므로 기존 로딩 로직이 작동합니다.
+            model.load_llm(load_args, **kwargs)
+            model.load_vision_tower(load_args, **kwargs)
+            model.load_connector(load_args, **kwargs)
+
+        if str(target_device) != 'cpu':
+            # 체크포인트에 없는 텐서(non-persistent buffer, strict=False로 빠진 파라미터 등)도 옮깁니다.
+            model.to(target_device)
 
         return model
             
@@ -265,7 +265,8 @@ class LLaVATrainer(Trainer):
         
         breakpoint()
         labels = inputs.get("labels")
-        student_outputs = model(**inputs)
+        # the distillation loss needs the student logits, which bucketed training steps skip otherwise
+        student_outputs = model(**inputs, return_logits=True) if self.teacher_model else model(**inputs)
         
         supervised_loss = student_outputs.loss
         if supervised_loss is None: